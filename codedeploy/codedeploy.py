@@ -1,15 +1,28 @@
 #!/usr/bin/python
 
+import hashlib
+import os
+import re
 import sys
 import time
+import zipfile
 import ConfigParser
 
+from io import BytesIO
 from subprocess import PIPE, Popen
 from boto.codedeploy import connect_to_region as codedeploy_connect
 from boto.cloudformation import connect_to_region as cfn_connect
+from boto.s3 import connect_to_region as s3_connect
 
 CFN_HUP_LOCATION = '/etc/cfn/cfn-hup.conf'
-GITHUB_REPOSITORY = 'stelligent/stelligent_demo'
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+#  The bundle is appspec.yml plus every files: source and hook location it
+#  references; nothing else goes in.
+APPSPEC = 'appspec.yml'
+APPSPEC_PATH = re.compile(r'^\s*-?\s*(source|location):\s*(\S+)\s*$',
+                          re.MULTILINE)
+BUNDLE_PREFIX = 'codedeploy'
+BUNDLE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 TIMEOUT = 600
 SLEEP_SECONDS = 10
 
@@ -24,7 +37,8 @@ def get_codedeploy_app_and_group(connection, arn):
     stack = connection.describe_stacks(arn)[0]
     parameters = {x.key: x.value for x in stack.parameters}
     return {'application': parameters['CodeDeployAppName'],
-            'group': parameters['CodeDeployDeploymentGroup']}
+            'group': parameters['CodeDeployDeploymentGroup'],
+            'bucket': parameters['StelligentDemoBucket']}
 
 
 def get_git_commit_id():
@@ -34,6 +48,84 @@ def get_git_commit_id():
     return output.rstrip()
 
 
+def get_appspec_paths(appspec=APPSPEC):
+    with open(os.path.join(REPO_ROOT, appspec)) as appspec_file:
+        text = appspec_file.read()
+    sources = list()
+    hooks = list()
+    for field, value in APPSPEC_PATH.findall(text):
+        name = os.path.normpath(value.strip('\'"').lstrip('/'))
+        if field == 'source':
+            sources.append(name)
+        else:
+            hooks.append(name)
+    return sources, hooks
+
+
+def get_bundle_files(appspec=APPSPEC):
+    # Fail here rather than on every instance when appspec.yml
+    # references something the bundle cannot contain.
+    sources, hooks = get_appspec_paths(appspec)
+    files = set([appspec])
+    for name in sources + hooks:
+        path = os.path.join(REPO_ROOT, name)
+        if name == '.':
+            files.update(x for x in os.listdir(REPO_ROOT)
+                         if os.path.isfile(os.path.join(REPO_ROOT, x)))
+        elif os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for x in names:
+                    files.add(os.path.relpath(os.path.join(root, x),
+                                              REPO_ROOT))
+        elif os.path.isfile(path):
+            files.add(name)
+        else:
+            sys.stderr.write("%s references %s, which does not exist.\n" %
+                             (appspec, name))
+            sys.exit(1)
+    for name in hooks:
+        if not os.path.isfile(os.path.join(REPO_ROOT, name)) or \
+                not os.access(os.path.join(REPO_ROOT, name), os.X_OK):
+            sys.stderr.write("%s hook %s is not an executable file.\n" %
+                             (appspec, name))
+            sys.exit(1)
+    return sorted(files)
+
+
+def build_bundle(files=None):
+    # Fixed order, timestamps and modes so that unchanged sources
+    # always produce byte-identical archives with the same hash.
+    if files is None:
+        files = get_bundle_files()
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in sorted(files):
+            path = os.path.join(REPO_ROOT, name)
+            info = zipfile.ZipInfo(name, date_time=BUNDLE_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.create_system = 3
+            if os.stat(path).st_mode & 0111:
+                info.external_attr = 0100755 << 16
+            else:
+                info.external_attr = 0100644 << 16
+            with open(path, 'rb') as opened_file:
+                zf.writestr(info, opened_file.read())
+    return archive.getvalue()
+
+
+def upload_bundle(s3_connection, bucket_name, bundle):
+    digest = hashlib.sha256(bundle).hexdigest()
+    key_name = '%s/%s.zip' % (BUNDLE_PREFIX, digest)
+    bucket = s3_connection.get_bucket(bucket_name, validate=False)
+    if bucket.get_key(key_name) is None:
+        bucket.new_key(key_name).set_contents_from_string(bundle)
+        print "Uploaded bundle s3://%s/%s" % (bucket_name, key_name)
+    else:
+        print "Bundle s3://%s/%s already uploaded" % (bucket_name, key_name)
+    # Single part uploads carry the MD5 of the body as their ETag
+    return key_name, hashlib.md5(bundle).hexdigest()
+
+
 def main():
     # Fetch our region and stack arn written during the cfn deployment
     region, stack_arn = get_stack_config(CFN_HUP_LOCATION)
@@ -42,6 +134,7 @@ def main():
     connections = dict()
     connections['cfn'] = cfn_connect(region)
     connections['codedeploy'] = codedeploy_connect(region)
+    connections['s3'] = s3_connect(region)
 
     # Fetch the codedeploy details from the cfn stack arn
     codedeploy = get_codedeploy_app_and_group(connections['cfn'], stack_arn)
@@ -49,18 +142,25 @@ def main():
     # Get the latest git revision number
     commit_id = get_git_commit_id()
 
+    # Bundle the appspec sources and push them to the ephemeral bucket
+    key_name, etag = upload_bundle(connections['s3'], codedeploy['bucket'],
+                                   build_bundle())
+
     # Create the codedeploy deployment
     revision = {
-                    'revisionType': 'GitHub',
-                    'gitHubLocation': {
-                        'repository': GITHUB_REPOSITORY,
-                        'commitId': commit_id
+                    'revisionType': 'S3',
+                    's3Location': {
+                        'bucket': codedeploy['bucket'],
+                        'key': key_name,
+                        'bundleType': 'zip',
+                        'eTag': etag
                     }
                }
     deploy_result = connections['codedeploy'].create_deployment(
         codedeploy['application'],
         codedeploy['group'],
-        revision
+        revision,
+        description='stelligent_demo commit %s' % commit_id
     )
 
     # Wait for deployment to complete before we exit
@@ -1,5 +1,11 @@
 from flask import Flask
+
+import health
+from sessions import ServerSessionInterface, make_session_store
+
 app = Flask(__name__)
+app.session_interface = ServerSessionInterface(make_session_store())
+health.init_app(app)
 
 @app.route('/')
 def hello_world():
@@ -0,0 +1 @@
+../docker-centos/health.py
\ No newline at end of file
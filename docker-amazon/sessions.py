@@ -0,0 +1 @@
+../docker-centos/sessions.py
\ No newline at end of file
@@ -1,12 +1,160 @@
-import time
-from flask import Flask
+import gzip
+import hashlib
+import mimetypes
+import os
+from io import BytesIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import Flask, Response, abort, request
 from werkzeug.contrib.fixers import ProxyFix
+from werkzeug.wsgi import wrap_file
+
+import health
+from sessions import ServerSessionInterface, make_session_store
+
+#  Static assets are read and compressed once at import. Anything at or over
+#  SENDFILE_BYTES is streamed from disk through the server's file wrapper
+#  (sendfile under gunicorn) instead of being held in memory.
+#
+#  Only URLs carrying the content hash (stelogo.<digest>.png, which the
+#  pages are rewritten to reference) are cached for STATIC_MAX_AGE. The
+#  page itself and the plain names are revalidated against their ETag on
+#  every use, so a redeploy shows up immediately.
+STATIC_ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_FILES = ['index.html', 'stelogo.png']
+STATIC_INDEX = 'index.html'
+STATIC_PAGE_TYPES = ('text/html',)
+STATIC_MAX_AGE = 31536000
+VERSIONED_CACHE_CONTROL = 'public, max-age=%d, immutable' % STATIC_MAX_AGE
+UNVERSIONED_CACHE_CONTROL = 'no-cache'
+VERSION_DIGEST_CHARS = 12
+SENDFILE_BYTES = 256 * 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json',
+                      'image/svg+xml')
+ENCODING_PREFERENCE = ['br', 'gzip']
+ASSETS = dict()
+
+
+def gzip_bytes(body):
+    buf = BytesIO()
+    #  Fixed mtime keeps the gzip bytes, and so the ETag, stable per build
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf,
+                       mtime=0) as gz:
+        gz.write(body)
+    return buf.getvalue()
+
+
+def read_asset(name):
+    with open(os.path.join(STATIC_ROOT, name), 'rb') as asset_file:
+        return asset_file.read()
+
+
+def asset_type(name):
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if content_type.startswith('text/'):
+        content_type += '; charset=utf-8'
+    return content_type
+
+
+def versioned_name(name, digest):
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, digest[:VERSION_DIGEST_CHARS], ext)
+
+
+def load_asset(name, body, cache_control, path=None):
+    """Build every encoding of one asset; path enables streaming from disk."""
+    content_type = asset_type(name)
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    variants = {'identity': body}
+    if content_type.startswith(COMPRESSIBLE_TYPES):
+        compressed = {'gzip': gzip_bytes(body)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(body)
+        for encoding, data in compressed.items():
+            if len(data) < len(body):
+                variants[encoding] = data
+    if path is not None and len(body) >= SENDFILE_BYTES:
+        variants['identity'] = None
+    representations = dict()
+    for encoding, data in variants.items():
+        etag = digest if encoding == 'identity' else \
+            '%s-%s' % (digest, encoding)
+        headers = [('Content-Type', content_type),
+                   ('Cache-Control', cache_control),
+                   ('ETag', '"%s"' % etag),
+                   ('Vary', 'Accept-Encoding')]
+        if encoding != 'identity':
+            headers.append(('Content-Encoding', encoding))
+        representations[encoding] = {'etag': etag, 'body': data,
+                                     'headers': headers}
+    return {'path': path, 'size': len(body), 'digest': digest,
+            'representations': representations}
+
+
+def load_assets():
+    pages = [name for name in STATIC_FILES
+             if asset_type(name).startswith(STATIC_PAGE_TYPES)]
+    versions = dict()
+    for name in STATIC_FILES:
+        if name in pages:
+            continue
+        path = os.path.join(STATIC_ROOT, name)
+        body = read_asset(name)
+        ASSETS[name] = load_asset(name, body, UNVERSIONED_CACHE_CONTROL, path)
+        versions[name] = versioned_name(name, ASSETS[name]['digest'])
+        ASSETS[versions[name]] = load_asset(name, body,
+                                            VERSIONED_CACHE_CONTROL, path)
+    #  Pages are served from memory because their references are rewritten
+    for name in pages:
+        body = read_asset(name)
+        for plain, versioned in versions.items():
+            body = body.replace(('"%s"' % plain).encode('utf-8'),
+                                ('"%s"' % versioned).encode('utf-8'))
+        ASSETS[name] = load_asset(name, body, UNVERSIONED_CACHE_CONTROL)
+
+
+def serve_asset(name):
+    asset = ASSETS.get(name)
+    if asset is None:
+        abort(404)
+    encoding = 'identity'
+    for candidate in ENCODING_PREFERENCE:
+        if candidate in asset['representations'] and \
+                request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    representation = asset['representations'][encoding]
+    if request.if_none_match.contains(representation['etag']):
+        return Response(status=304, headers=representation['headers'])
+    if representation['body'] is None:
+        response = Response(
+            wrap_file(request.environ, open(asset['path'], 'rb')),
+            headers=representation['headers'], direct_passthrough=True)
+        response.content_length = asset['size']
+        return response
+    return Response(representation['body'],
+                    headers=representation['headers'])
+
+
+load_assets()
 
 app = Flask(__name__)
+app.session_interface = ServerSessionInterface(make_session_store())
+health.init_app(app)
 @app.route('/')
 
 def hello_world():
-    return "stelligent-demo via docker"
+    return serve_asset(STATIC_INDEX)
+
+
+@app.route('/<name>')
+def static_asset(name):
+    return serve_asset(name)
+
 
 app.wsgi_app = ProxyFix(app.wsgi_app)
 
@@ -12,7 +12,7 @@ chmod 600 ~/.ssh/$stackName.pem
 echo
 rm -fv stelligent-demo.zip
 echo
-zip stelligent-demo.zip Dockerfile application.py requirements.txt
+zip stelligent-demo.zip Dockerfile application.py requirements.txt index.html stelogo.png health.py sessions.py
 echo
 aws s3 cp stelligent-demo.zip s3://$bucketName
 echo
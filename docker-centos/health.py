@@ -0,0 +1,109 @@
+"""Liveness and readiness endpoints shared by the demo apps.
+
+/readyz only reads a result cached by a background checker, so health
+checks never block on I/O. The checker is started on the first request in
+each process rather than at import, because preforking servers (uWSGI
+without lazy-apps) import the app in a master that never serves requests.
+uWSGI also needs enable-threads for the checker to run at all.
+"""
+import os
+import socket
+import threading
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+#  Leave STELLIGENT_DEMO_DB_HOST unset to skip the database check, and set
+#  STELLIGENT_DEMO_CHECK_METADATA=0 off of EC2.
+DB_HOST = os.environ.get('STELLIGENT_DEMO_DB_HOST')
+DB_PORT = int(os.environ.get('STELLIGENT_DEMO_DB_PORT', '3306'))
+CHECK_METADATA = os.environ.get('STELLIGENT_DEMO_CHECK_METADATA', '1') == '1'
+METADATA_URL = 'http://169.254.169.254/latest/meta-data/instance-id'
+#  Touch this file to start draining; /readyz flips within DRAIN_POLL.
+DRAIN_FILE = os.environ.get('STELLIGENT_DEMO_DRAIN_FILE',
+                            '/tmp/stelligent-demo.drain')
+CHECK_INTERVAL = 10
+CHECK_TIMEOUT = 2
+DRAIN_POLL = 1
+TEXT_HEADERS = {'Content-Type': 'text/plain', 'Cache-Control': 'no-store'}
+
+READINESS = {'pid': None, 'ready': False, 'draining': False,
+             'failing': ['starting']}
+CHECKER_LOCK = threading.Lock()
+
+
+def check_database():
+    if not DB_HOST:
+        return True
+    try:
+        connection = socket.create_connection((DB_HOST, DB_PORT),
+                                              CHECK_TIMEOUT)
+    except (socket.error, socket.timeout):
+        return False
+    connection.close()
+    return True
+
+
+def check_metadata():
+    if not CHECK_METADATA:
+        return True
+    try:
+        urlopen(METADATA_URL, timeout=CHECK_TIMEOUT).close()
+    except Exception:
+        return False
+    return True
+
+
+def refresh_readiness():
+    checks = {'database': check_database(), 'metadata': check_metadata()}
+    failing = sorted(name for name, ok in checks.items() if not ok)
+    READINESS['failing'] = failing
+    READINESS['ready'] = not failing
+
+
+def readiness_loop():
+    last_checked = 0
+    while True:
+        READINESS['draining'] = os.path.exists(DRAIN_FILE)
+        if time.time() - last_checked >= CHECK_INTERVAL:
+            refresh_readiness()
+            last_checked = time.time()
+        time.sleep(DRAIN_POLL)
+
+
+def ensure_checker():
+    pid = os.getpid()
+    if READINESS['pid'] == pid:
+        return
+    with CHECKER_LOCK:
+        if READINESS['pid'] == pid:
+            return
+        #  A forked worker inherits the parent's state but not its thread
+        READINESS.update({'ready': False, 'draining': False,
+                          'failing': ['starting']})
+        checker = threading.Thread(target=readiness_loop, name='readiness')
+        checker.daemon = True
+        checker.start()
+        READINESS['pid'] = pid
+
+
+def healthz():
+    return 'ok', 200, TEXT_HEADERS
+
+
+def readyz():
+    if READINESS['draining']:
+        return 'draining', 503, TEXT_HEADERS
+    if not READINESS['ready']:
+        return 'unready: %s' % ', '.join(READINESS['failing']), 503, \
+            TEXT_HEADERS
+    return 'ready', 200, TEXT_HEADERS
+
+
+def init_app(app):
+    app.before_request(ensure_checker)
+    app.add_url_rule('/healthz', 'healthz', healthz)
+    app.add_url_rule('/readyz', 'readyz', readyz)
@@ -0,0 +1,276 @@
+"""Server-side Flask sessions for the demo apps.
+
+Session data lives in a shared backend (ElastiCache Redis in AWS) so any
+instance behind the ELB can serve any user. Each worker keeps a small LRU
+near-cache in front of it, so repeat lookups within NEAR_CACHE_TTL never
+leave the process. The near-cache holds the encoded JSON and decodes it on
+every hit, so a request that changes its session in place without saving
+never leaks into the next one. Writes go through to the backend immediately.
+
+Backend entries expire SESSION_TTL after the last access, or after
+app.permanent_session_lifetime for permanent sessions. Reads refresh the
+expiry (at most once per NEAR_CACHE_TTL per worker) unless
+SESSION_REFRESH_EACH_REQUEST is off.
+
+Requests that can change state (anything but GET, HEAD and OPTIONS, so a
+login or logout form) always read the backend, and a worker never caches
+a session again once it has deleted it. A safe request on another worker
+may still see a changed or deleted session for up to NEAR_CACHE_TTL.
+
+Set STELLIGENT_DEMO_SESSION_URL (redis://host:6379/0) to use Redis. Without
+it, or in tests, MemoryBackend stands in for the shared store.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+SESSION_URL = os.environ.get('STELLIGENT_DEMO_SESSION_URL')
+SESSION_PREFIX = 'stelligent-demo:session:'
+SESSION_TTL = 3600
+#  Short enough that a session written by another worker is picked up
+#  quickly, long enough to absorb the requests of a single page load.
+NEAR_CACHE_TTL = 5
+NEAR_CACHE_ITEMS = 1024
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class LRUCache(object):
+    """Thread safe LRU with a per-entry TTL."""
+
+    def __init__(self, max_items=NEAR_CACHE_ITEMS, ttl=NEAR_CACHE_TTL):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._deleted = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self._items[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._deleted:
+                return
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + self.ttl, value)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+            #  Session ids are never reused, so a deleted one stays out
+            #  even if a request that read it earlier finishes afterwards
+            self._deleted[key] = True
+            while len(self._deleted) > self.max_items:
+                self._deleted.popitem(last=False)
+
+
+class MemoryBackend(object):
+    """In-process stand-in for the shared store, for tests and local runs."""
+
+    def __init__(self):
+        self._items = dict()
+        self._lock = threading.Lock()
+        self.round_trips = 0
+
+    def get_many(self, keys):
+        with self._lock:
+            self.round_trips += 1
+            now = time.time()
+            values = list()
+            for key in keys:
+                entry = self._items.get(key)
+                values.append(entry[1] if entry and entry[0] > now else None)
+            return values
+
+    def set_many(self, mapping, ttl):
+        with self._lock:
+            self.round_trips += 1
+            expires = time.time() + ttl
+            for key, value in mapping.items():
+                self._items[key] = (expires, value)
+
+    def expire_many(self, keys, ttl):
+        with self._lock:
+            self.round_trips += 1
+            now = time.time()
+            for key in keys:
+                entry = self._items.get(key)
+                if entry and entry[0] > now:
+                    self._items[key] = (now + ttl, entry[1])
+
+    def delete_many(self, keys):
+        with self._lock:
+            self.round_trips += 1
+            for key in keys:
+                self._items.pop(key, None)
+
+
+class RedisBackend(object):
+    """Redis (ElastiCache) store; batches cost one round trip each."""
+
+    def __init__(self, client, prefix=SESSION_PREFIX):
+        self.client = client
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        return self.client.mget([self.prefix + key for key in keys])
+
+    def set_many(self, mapping, ttl):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipeline.setex(self.prefix + key, ttl, value)
+        pipeline.execute()
+
+    def expire_many(self, keys, ttl):
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.expire(self.prefix + key, ttl)
+        pipeline.execute()
+
+    def delete_many(self, keys):
+        self.client.delete(*[self.prefix + key for key in keys])
+
+
+class SessionStore(object):
+    """Near-cache in front of a backend, with batched reads and writes."""
+
+    def __init__(self, backend, ttl=SESSION_TTL, near_cache=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.near_cache = near_cache or LRUCache()
+        self.touched = LRUCache()
+
+    def get_many(self, sids, fresh=False):
+        found = dict()
+        misses = list()
+        for sid in sids:
+            raw = None if fresh else self.near_cache.get(sid)
+            if raw is None:
+                misses.append(sid)
+            else:
+                found[sid] = json.loads(raw)
+        if misses:
+            for sid, raw in zip(misses, self.backend.get_many(misses)):
+                if raw is None:
+                    if fresh:
+                        self.near_cache.delete(sid)
+                    continue
+                if isinstance(raw, bytes):
+                    raw = raw.decode('utf-8')
+                self.near_cache.set(sid, raw)
+                found[sid] = json.loads(raw)
+        return found
+
+    def get(self, sid, fresh=False):
+        return self.get_many([sid], fresh=fresh).get(sid)
+
+    def set_many(self, sessions, ttl=None):
+        encoded = dict((sid, json.dumps(data))
+                       for sid, data in sessions.items())
+        self.backend.set_many(encoded, ttl or self.ttl)
+        for sid, raw in encoded.items():
+            self.near_cache.set(sid, raw)
+            self.touched.set(sid, True)
+
+    def set(self, sid, data, ttl=None):
+        self.set_many({sid: data}, ttl)
+
+    def touch_many(self, sids, ttl=None):
+        stale = [sid for sid in sids if self.touched.get(sid) is None]
+        if not stale:
+            return
+        self.backend.expire_many(stale, ttl or self.ttl)
+        for sid in stale:
+            self.touched.set(sid, True)
+
+    def touch(self, sid, ttl=None):
+        self.touch_many([sid], ttl)
+
+    def delete_many(self, sids):
+        self.backend.delete_many(sids)
+        for sid in sids:
+            self.near_cache.delete(sid)
+            self.touched.delete(sid)
+
+    def delete(self, sid):
+        self.delete_many([sid])
+
+
+class ServerSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps only a random session id in the cookie."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def get_store_ttl(self, app, session):
+        if session.permanent:
+            return int(app.permanent_session_lifetime.total_seconds())
+        return self.store.ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid:
+            data = self.store.get(sid,
+                                  fresh=request.method not in SAFE_METHODS)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession(sid=uuid.uuid4().hex, new=True)
+
+    def save_session(self, app, session, response):
+        cookie_name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(cookie_name, domain=domain, path=path)
+            return
+        ttl = self.get_store_ttl(app, session)
+        if session.modified:
+            self.store.set(session.sid, dict(session), ttl)
+        elif app.config['SESSION_REFRESH_EACH_REQUEST']:
+            self.store.touch(session.sid, ttl)
+        if not self.should_set_cookie(app, session):
+            return
+        response.set_cookie(cookie_name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            secure=self.get_cookie_secure(app),
+                            domain=domain, path=path)
+
+
+def make_session_store(url=SESSION_URL):
+    if not url:
+        return SessionStore(MemoryBackend())
+    if redis is None:
+        raise ImportError("redis is required for STELLIGENT_DEMO_SESSION_URL")
+    return SessionStore(RedisBackend(redis.StrictRedis.from_url(url)))
@@ -1,20 +1,33 @@
 #!/usr/bin/env python
 
 import argparse
+import cgi
+import copy
 import getpass
+import gzip
 import hashlib
+import httplib
 import json
 import os
 import re
+import select
+import shutil
 import socket
+import SocketServer
+import sqlite3
 import sys
+import threading
 import time
+import traceback
 import zipfile
-from datetime import datetime
+from datetime import datetime, timedelta
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 from time import sleep
 
 from boto.cloudformation import connect_to_region as cfn_connect
+from boto.cloudformation import regions as cfn_regions
 from boto.codedeploy import connect_to_region as codedeploy_connect
 from boto.ec2 import connect_to_region as ec2_connect
 from boto.exception import BotoServerError, EC2ResponseError, S3ResponseError
@@ -69,7 +82,12 @@ JENKINS_USER = 'stelligent_demo'
 JENKINS_EMAIL = 'stelligent@example.com'
 JENKINS_PASSWORD = 'changeme123'
 INGRESS_PORTS = ['22', '2222', '8080']
-ALLOWED_ACTIONS = ["build", "destroy", "info", "test"]
+ALLOWED_ACTIONS = ["build", "destroy", "fetch", "history", "info", "serve",
+                   "status", "sweep", "test"]
+DAEMON_ACTIONS = ["build", "destroy", "info", "status"]
+#  The daemon runs these one at a time; the others are served alongside them
+DAEMON_EXCLUSIVE_ACTIONS = ["build", "destroy"]
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
 
 #  FIXME: These are hard-coded elsewhere, make dynamic everywhere.
 CODEDEPLOY_APP_NAME = 'stelligent-demo'
@@ -94,6 +112,62 @@ DEMO_ECS = 'StelligentDemoECS'
 DEMO_S3_BUCKET = 'StelligentDemoBucket'  # Ephemeral Bucket
 DEMO_DOCKER_ENV = 'StelligentDemoDockerEnvironment'
 
+#  Sweeper settings. Resources younger than the grace period are left alone
+#  so an in-flight build does not lose its key pair or role mid-launch.
+SWEEP_WORKERS = 8
+SWEEP_GRACE_HOURS = 2
+SWEEP_SKIP_REGION_PREFIXES = ('cn-', 'us-gov-')
+SWEEP_SHARED_TYPES = ['VPC', 'SG', 'RDS']
+
+#  Local build history used for wait ETAs and the history report.
+HISTORY_DB = 'stelligent-demo-history.db'
+HISTORY_WINDOW = 10
+HISTORY_REGRESSION_RATIO = 1.25
+BUILD_HISTORY = {'db': None, 'build_id': None, 'region': None,
+                 'started': None}
+
+#  Daemon mode (go.py serve). These caches live for the whole process, so a
+#  long-running daemon reuses them across requests. Requests each get a
+#  thread; build and destroy hold DAEMON_EXCLUSIVE_LOCK.
+DAEMON_SOCKET = '/tmp/stelligent-demo.sock'
+DAEMON_EXIT_MARKER = '\0go.py-exit:'
+STACK_CACHE_SECONDS = 30
+#  boto connections are not thread safe, so idle sets are checked out to
+#  one request at a time
+CONNECTION_POOL = dict()
+CONNECTION_POOL_LOCK = threading.Lock()
+DAEMON_EXCLUSIVE_LOCK = threading.Lock()
+STACK_CACHE = dict()
+TEMPLATE_CACHE = dict()
+ARTIFACT_HASHES = dict()
+
+#  Fetching demo outputs and logs back from the ephemeral bucket. Objects
+#  larger than FETCH_PART_SIZE are pulled as concurrent ranged GETs.
+FETCH_DIR = 'fetch'
+FETCH_WORKERS = 8
+FETCH_PART_SIZE = 8 * 1024 * 1024
+#  boto connections are not thread safe, so each worker thread keeps its own
+THREAD_BUCKETS = threading.local()
+
+#  Stack outputs published to the ephemeral bucket after a build. S3 sends
+#  stored bytes whatever the client accepts, so only the HTML page meant for
+#  browsers is gzipped; JSON and text stay plain for scripts.
+OUTPUTS_CACHE_CONTROL = 'public, max-age=300'
+OUTPUTS_HTML = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
+    <title>Demo Index File in S3 Bucket</title>
+</head>
+
+<body>
+<h1>Stelligent Demo Stack</h1>
+<pre>
+%s</pre>
+</body>
+</html>
+"""
+
 
 def ip_address_type(location):
     try:
@@ -105,10 +179,74 @@ def ip_address_type(location):
         return location
 
 
-def list_and_get_stacks(cfn_connection, allow_all=False):
+def timestamp_type(value):
+    for timestamp_format in (TIMESTAMP_FORMAT, '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, timestamp_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("%s is not YYYYMMDDHHMMSS or YYYY-MM-DD" %
+                                     value)
+
+
+def checkout_connections(region):
+    with CONNECTION_POOL_LOCK:
+        idle = CONNECTION_POOL.setdefault(region, list())
+        if idle:
+            return idle.pop()
+    connections = dict()
+    connections['cfn'] = cfn_connect(region)
+    connections['codedeploy'] = codedeploy_connect(region)
+    connections['ec2'] = ec2_connect(region)
+    connections['iam'] = iam_connect(region)
+    connections['s3'] = s3_connect(region)
+    return connections
+
+
+def checkin_connections(region, connections):
+    with CONNECTION_POOL_LOCK:
+        CONNECTION_POOL[region].append(connections)
+
+
+def describe_all_stacks(cfn_connection):
+    region = cfn_connection.region.name
+    cached = STACK_CACHE.get(region)
+    if cached and time.time() - cached[0] < STACK_CACHE_SECONDS:
+        return cached[1]
+    stacks = cfn_connection.describe_stacks()
+    STACK_CACHE[region] = (time.time(), stacks)
+    return stacks
+
+
+def invalidate_stack_cache(cfn_connection):
+    STACK_CACHE.pop(cfn_connection.region.name, None)
+
+
+def load_template(path):
+    mtime = os.path.getmtime(path)
+    cached = TEMPLATE_CACHE.get(path)
+    if not cached or cached[0] != mtime:
+        with open(path) as data_file:
+            cached = (mtime, json.load(data_file))
+        TEMPLATE_CACHE[path] = cached
+    #  Callers inject locations and parameters, so hand out a copy
+    return copy.deepcopy(cached[1])
+
+
+def get_thread_bucket(region, bucket_name):
+    buckets = THREAD_BUCKETS.__dict__.setdefault('buckets', dict())
+    if bucket_name not in buckets:
+        buckets[bucket_name] = s3_connect(region).get_bucket(bucket_name,
+                                                             validate=False)
+    return buckets[bucket_name]
+
+
+def list_and_get_stacks(cfn_connection, allow_all=False, stack_types=None):
     stack_list = []
-    all_stacks = cfn_connection.describe_stacks()
+    all_stacks = describe_all_stacks(cfn_connection)
     for type in STACK_DATA:
+        if stack_types and STACK_DATA[type]['type'] not in stack_types:
+            continue
         match_stacks = [[stack, STACK_DATA[type]['type']] for
                         stack in all_stacks if
                         re.match('%s-(\d+)$' % STACK_DATA[type]['prefix'],
@@ -144,6 +282,14 @@ def list_and_get_stacks(cfn_connection, allow_all=False):
 
 
 def prepare_docker_zip():
+    inputs = [(f, os.path.getmtime(os.path.join('docker', f)),
+               os.path.getsize(os.path.join('docker', f)))
+              for f in DOCKER_FILES]
+    inputs_hash = hashlib.md5(repr(inputs)).hexdigest()
+    if ARTIFACT_HASHES.get(DOCKER_ZIPFILE) == inputs_hash and \
+            os.path.isfile(DOCKER_ZIPFILE):
+        print "%s is up to date." % DOCKER_ZIPFILE
+        return
     sys.stdout.write("Repacking %s..." % DOCKER_ZIPFILE)
     sys.stdout.flush()
     try:
@@ -151,10 +297,9 @@ def prepare_docker_zip():
     except OSError:
         pass
     with zipfile.ZipFile(DOCKER_ZIPFILE, mode='w') as zf:
-        os.chdir('docker')
         for f in DOCKER_FILES:
-            zf.write(f)
-        os.chdir('..')
+            zf.write(os.path.join('docker', f), f)
+    ARTIFACT_HASHES[DOCKER_ZIPFILE] = inputs_hash
     print "Done!"
 
 
@@ -171,30 +316,51 @@ def copy_files_to_s3(s3_connection, bucket, files):
     print "Done!"
 
 
-def create_and_upload_index_to_s3(s3, outputs=None):
-    outputs = outputs or dict()
-    output_key = "StelligentDemoBucketURL"
-    bucket_url = ([output.value for output in outputs
-                  if output.key == output_key])[0]
-    bucket_name = re.sub(r'http://(.*).s3-website.*', r'\1', bucket_url)
-    contents = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
-    <html xmlns="http://www.w3.org/1999/xhtml">
-    <head>
-    <meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
-        <title>Demo Index File in S3 Bucket</title>
-    </head>
-
-    <body>
-    <h1>Stelligent Demo Stack</h1>
-    <pre>"""
-    for output in outputs:
-        contents += "%40s : %s\n" % (output.key, output.value)
-    s3_bucket = s3.get_bucket(bucket_name)
-    s3_key = S3Key(s3_bucket)
-    s3_key.key = "index.html"
-    s3_key.set_metadata('Content-Type', 'text/html')
-    s3_key.set_contents_from_string(contents)
-    s3_key.set_acl('public-read')
+def gzip_string(contents):
+    buf = BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0) as gz:
+        gz.write(contents)
+    return buf.getvalue()
+
+
+def render_outputs(outputs):
+    pairs = [(output.key, output.value) for output in outputs]
+    text = "".join("%40s : %s\n" % pair for pair in pairs)
+    return [('index.html', 'text/html; charset=utf-8', True,
+             OUTPUTS_HTML % cgi.escape(text)),
+            ('outputs.json', 'application/json', False,
+             json.dumps(dict(pairs), indent=2, sort_keys=True) + "\n"),
+            ('outputs.txt', 'text/plain; charset=utf-8', False, text)]
+
+
+def publish_output_document(task):
+    region, bucket_name, key_name, content_type, compress, contents = task
+    headers = {'Content-Type': content_type,
+               'Cache-Control': OUTPUTS_CACHE_CONTROL}
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+    if compress:
+        contents = gzip_string(contents)
+        headers['Content-Encoding'] = 'gzip'
+    s3_key = get_thread_bucket(region, bucket_name).new_key(key_name)
+    #  The canned ACL rides along on the PUT, no separate set_acl call
+    s3_key.set_contents_from_string(contents, headers=headers,
+                                    policy='public-read')
+    return key_name
+
+
+def publish_outputs(region, outputs):
+    bucket_name = {x.key: x.value for x in outputs}[DEMO_S3_BUCKET]
+    documents = render_outputs(outputs)
+    sys.stdout.write("Publishing outputs to %s..." % bucket_name)
+    sys.stdout.flush()
+    pool = ThreadPool(len(documents))
+    published = pool.map(publish_output_document,
+                         [(region, bucket_name) + document
+                          for document in documents])
+    pool.close()
+    pool.join()
+    print "Done! (%s)" % ", ".join(published)
 
 
 def delete_stack_name_from_s3(s3_connection, bucket, target):
@@ -300,8 +466,7 @@ def get_or_create_stack(cfn_connection, all_stacks, stack_data, timestamp,
     else:
         created = True
         stack_name = '%s-%s' % (stack_data['prefix'], timestamp)
-        with open(stack_data['template']) as data_file:
-            data = json.load(data_file)
+        data = load_template(stack_data['template'])
         if stack_data['type'] == 'S3':
             for location in locations:
                 data['Resources']['StelligentDemoBucketPolicy']['Properties']['PolicyDocument']['Statement'][0]['Condition']['IpAddress']['aws:SourceIp'].append(location)
@@ -428,30 +593,146 @@ def empty_related_buckets(s3_connection, bucket_name):
         pass
 
 
+def open_history():
+    db = sqlite3.connect(HISTORY_DB)
+    db.execute("""CREATE TABLE IF NOT EXISTS builds (
+                      id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      started TEXT,
+                      region TEXT,
+                      stack_name TEXT,
+                      template_hash TEXT,
+                      status TEXT,
+                      duration REAL)""")
+    db.execute("""CREATE TABLE IF NOT EXISTS phases (
+                      build_id INTEGER REFERENCES builds(id),
+                      phase TEXT,
+                      duration REAL,
+                      api_calls INTEGER)""")
+    db.execute("""CREATE INDEX IF NOT EXISTS phases_by_name
+                  ON phases (phase, build_id)""")
+    return db
+
+
+def hash_templates():
+    digest = hashlib.md5()
+    for key in sorted(STACK_DATA):
+        with open(STACK_DATA[key]['template']) as template:
+            digest.update(template.read())
+    return digest.hexdigest()
+
+
+def start_build_history(region, stack_name):
+    db = open_history()
+    cursor = db.execute(
+        "INSERT INTO builds (started, region, stack_name, template_hash, "
+        "status) VALUES (?, ?, ?, ?, ?)",
+        (datetime.now().strftime(TIMESTAMP_FORMAT), region, stack_name,
+         hash_templates(), 'IN_PROGRESS'))
+    db.commit()
+    BUILD_HISTORY['db'] = db
+    BUILD_HISTORY['build_id'] = cursor.lastrowid
+    BUILD_HISTORY['region'] = region
+    BUILD_HISTORY['started'] = time.time()
+
+
+def record_phase(phase, duration, api_calls):
+    db = BUILD_HISTORY['db']
+    if db is None:
+        return
+    db.execute("INSERT INTO phases (build_id, phase, duration, api_calls) "
+               "VALUES (?, ?, ?, ?)",
+               (BUILD_HISTORY['build_id'], phase, duration, api_calls))
+    db.commit()
+
+
+def finish_build_history(status):
+    db = BUILD_HISTORY['db']
+    if db is None:
+        return
+    db.execute("UPDATE builds SET status = ?, duration = ? WHERE id = ?",
+               (status, time.time() - BUILD_HISTORY['started'],
+                BUILD_HISTORY['build_id']))
+    db.commit()
+    db.close()
+    BUILD_HISTORY['db'] = None
+    BUILD_HISTORY['build_id'] = None
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def phase_durations(db, phase, region, before_id, limit=HISTORY_WINDOW):
+    rows = db.execute(
+        "SELECT phases.duration FROM phases JOIN builds "
+        "ON phases.build_id = builds.id WHERE phases.phase = ? "
+        "AND builds.region = ? AND builds.id < ? "
+        "ORDER BY builds.id DESC LIMIT ?",
+        (phase, region, before_id, limit))
+    return [row[0] for row in rows]
+
+
+def estimate_phase(phase):
+    db = BUILD_HISTORY['db']
+    if db is None:
+        return None
+    return median(phase_durations(db, phase, BUILD_HISTORY['region'],
+                                  BUILD_HISTORY['build_id']))
+
+
+def format_duration(seconds):
+    return "%dm%02ds" % divmod(int(seconds), 60)
+
+
+def eta_label(estimate, started):
+    if estimate is None:
+        return ""
+    remaining = estimate - (time.time() - started)
+    if remaining >= 0:
+        return " (ETA %s)" % format_duration(remaining)
+    return " (%s over typical)" % format_duration(-remaining)
+
+
 def get_resource_id(cfn_connection, stack_name, resource_name=None, wait=True):
     #  Initial Check
     if resource_name:
         resource_label = resource_name
+        phase = resource_name
     else:
         resource_label = stack_name
+        phase = get_stack_type(stack_name) or stack_name
+    if not wait:
+        phase = "%s (start)" % phase
+    estimate = estimate_phase(phase)
+    started = time.time()
+    api_calls = 0
     status = "NOT_STARTED"
     waited = False
     while status != "CREATE_COMPLETE":
         try:
             #  FIXME: Must be a better way...
             if resource_name:
+                api_calls += 1
                 resource = cfn_connection.describe_stack_resources(
                     stack_name, resource_name)[0]
                 status = resource.resource_status
                 resource_id = resource.physical_resource_id
                 if not wait and resource_id:
                     if waited:
-                        sys.stdout.write("\rWaiting for %s...Started!" %
-                                         resource_label)
+                        sys.stdout.write("\rWaiting for %s...Started!%s" %
+                                         (resource_label, " " * 24))
                         sys.stdout.flush()
                         sys.stdout.write("\n")
+                    record_phase(phase, time.time() - started, api_calls)
                     return resource_id
             else:
+                api_calls += 2
                 status = cfn_connection.describe_stacks(
                     stack_name)[0].stack_status
                 resource_id = cfn_connection.describe_stacks(
@@ -459,13 +740,16 @@ def get_resource_id(cfn_connection, stack_name, resource_name=None, wait=True):
         except IndexError:
             pass
         waited = True
-        sys.stdout.write("\rWaiting for %s.       " % resource_label)
+        sys.stdout.write("\rWaiting for %s.  %s     " %
+                         (resource_label, eta_label(estimate, started)))
         sys.stdout.flush()
         sleep(1)
-        sys.stdout.write("\rWaiting for %s..      " % resource_label)
+        sys.stdout.write("\rWaiting for %s.. %s     " %
+                         (resource_label, eta_label(estimate, started)))
         sys.stdout.flush()
         sleep(1)
-        sys.stdout.write("\rWaiting for %s...     " % resource_label)
+        sys.stdout.write("\rWaiting for %s...%s     " %
+                         (resource_label, eta_label(estimate, started)))
         sys.stdout.flush()
         sleep(1)
         if status.endswith('FAILED'):
@@ -473,9 +757,11 @@ def get_resource_id(cfn_connection, stack_name, resource_name=None, wait=True):
             print "Stack Failed. Exiting..."
             sys.exit(1)
         if status.endswith('COMPLETE'):
-            sys.stdout.write("\rWaiting for %s...Done!" % resource_label)
+            sys.stdout.write("\rWaiting for %s...Done!%s" %
+                             (resource_label, " " * 24))
             sys.stdout.flush()
             sys.stdout.write("\n")
+    record_phase(phase, time.time() - started, api_calls)
     return resource_id
 
 
@@ -505,9 +791,29 @@ def fetch_parameters(outputs, params=list()):
 
 
 def build(connections, args):
+    timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+    start_build_history(args.region, "%s-%s" % (STACK_DATA['main']['prefix'],
+                                                timestamp))
+    #  Every way out of a build closes its history row; the warm path has
+    #  already recorded itself by the time it exits.
+    status = 'FAILED'
+    try:
+        build_stacks(connections, args, timestamp)
+        status = 'COMPLETE'
+    except KeyboardInterrupt:
+        status = 'ABORTED'
+        raise
+    except SystemExit as e:
+        if not e.code:
+            status = 'ABORTED'
+        raise
+    finally:
+        finish_build_history(status)
+
+
+def build_stacks(connections, args, timestamp):
     locations = add_cidr_subnet(args.locations)
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    all_stacks = connections['cfn'].describe_stacks()
+    all_stacks = describe_all_stacks(connections['cfn'])
     if args.warm:
         print "Only launching VPC, SG, and RDS in %s..." % args.region
     else:
@@ -555,6 +861,8 @@ def build(connections, args):
     )
     if args.warm:
         print "Warming complete. VPC, SG, and RDS found or created."
+        invalidate_stack_cache(connections['cfn'])
+        finish_build_history('WARM')
         sys.exit(0)
     #  Wait for S3
     get_resource_id(connections['cfn'], s3_stack)
@@ -589,8 +897,7 @@ def build(connections, args):
     build_params.append(("JenkinsUser", args.jenkins_user))
     build_params.append(("JenkinsEmail", args.jenkins_email))
     build_params.append(("JenkinsPassword", args.jenkins_password))
-    with open(STACK_DATA['main']['template']) as data_file:
-        data = json.load(data_file)
+    data = load_template(STACK_DATA['main']['template'])
     #  Inject locations
     data = inject_locations(locations, data)
     #  Inject Custom AMI
@@ -613,6 +920,7 @@ def build(connections, args):
     sys.stdout.write("Launching CloudFormation Stack in %s..." % args.region)
     sys.stdout.flush()
     create_cfn_stack(connections['cfn'], stack_name, data, build_params)
+    invalidate_stack_cache(connections['cfn'])
     print "Done!"
     #  Give Feedback whilst we wait...
     asg_stack_id = get_resource_id(connections['cfn'], stack_name, ASG_STACK,
@@ -640,8 +948,8 @@ def build(connections, args):
     #  outputs = main_outputs + eb_outputs + ecs_outputs
     outputs = main_outputs + ecs_outputs
     outputs = sorted(outputs, key=lambda k: k.key)
-    #  Upload index.html to transient demo bucket
-    create_and_upload_index_to_s3(connections['s3'], outputs)
+    #  Upload index.html, outputs.json and outputs.txt to transient demo bucket
+    publish_outputs(args.region, outputs)
     print "Outputs:"
     for output in outputs:
         print '%s = %s' % (output.key, output.value)
@@ -683,6 +991,263 @@ def destroy(connections, args):
                          stack.stack_name)
         print "Deleting!"
         connections['cfn'].delete_stack(stack.stack_name)
+    invalidate_stack_cache(connections['cfn'])
+
+
+def get_stack_type(stack_name):
+    for stack_data in STACK_DATA.values():
+        if re.match('%s-(\d+)$' % stack_data['prefix'], stack_name):
+            return stack_data['type']
+    return None
+
+
+def stack_failed(stack):
+    return (stack.stack_status.endswith('FAILED') or
+            stack.stack_status == 'ROLLBACK_COMPLETE')
+
+
+def past_sweep_grace(created, now=None):
+    now = now or datetime.now()
+    return now - created > timedelta(hours=SWEEP_GRACE_HOURS)
+
+
+def inventory_region(region):
+    inventory = {'region': region, 'stacks': [], 'key_pairs': [],
+                 'applications': [], 'error': None}
+    #  connect_to_region returns None where boto knows no endpoint
+    cfn_connection = cfn_connect(region)
+    if cfn_connection is None:
+        inventory['error'] = "CloudFormation is not available"
+        return inventory
+    try:
+        next_token = None
+        while True:
+            stacks = cfn_connection.describe_stacks(next_token=next_token)
+            inventory['stacks'].extend(
+                [stack for stack in stacks
+                 if get_stack_type(stack.stack_name)])
+            next_token = stacks.next_token
+            if not next_token:
+                break
+        ec2_connection = ec2_connect(region)
+        if ec2_connection is not None:
+            key_prefix = STACK_DATA['main']['key_prefix']
+            inventory['key_pairs'] = [
+                kp.name for kp in ec2_connection.get_all_key_pairs()
+                if re.match('%s-(\d{14})$' % key_prefix, kp.name)]
+        codedeploy_connection = codedeploy_connect(region)
+        app_prefix = '%s-%s-' % (CODEDEPLOY_APP_NAME, region)
+        next_token = None
+        while codedeploy_connection is not None:
+            result = codedeploy_connection.list_applications(
+                next_token=next_token)
+            inventory['applications'].extend(
+                [app for app in result.get('applications', [])
+                 if app.startswith(app_prefix)])
+            next_token = result.get('nextToken')
+            if not next_token:
+                break
+    except BotoServerError as e:
+        inventory['error'] = e.error_message or e.reason
+    return inventory
+
+
+def inventory_iam_roles():
+    iam_connection = iam_connect(DEFAULT_REGION)
+    roles = list()
+    marker = None
+    while True:
+        response = iam_connection.list_roles(marker=marker)
+        result = response['list_roles_response']['list_roles_result']
+        for role in result['roles']:
+            match = re.match(r'%s-([a-z]+-[a-z]+-\d+)-(.+)$' % IAM_ROLE_NAME,
+                             role['role_name'])
+            if match:
+                created = datetime.strptime(role['create_date'][:19],
+                                            '%Y-%m-%dT%H:%M:%S')
+                roles.append({'name': role['role_name'],
+                              'region': match.group(1),
+                              'hash_id': match.group(2),
+                              'created': created})
+        if result['is_truncated'] != 'true':
+            break
+        marker = result['marker']
+    return roles
+
+
+def find_orphans(inventories, roles, regions):
+    orphans = {'stacks': [], 'key_pairs': [], 'applications': [],
+               'roles': []}
+    live_keys = set()
+    live_hashes = set()
+    live_timestamps = set()
+    for inventory in inventories:
+        region = inventory['region']
+        for stack in inventory['stacks']:
+            if stack_failed(stack) or \
+                    stack.stack_status == 'DELETE_IN_PROGRESS':
+                continue
+            parameters = {x.key: x.value for x in stack.parameters}
+            if 'KeyName' in parameters:
+                live_keys.add((region, parameters['KeyName']))
+            if get_stack_type(stack.stack_name) == 'MAIN':
+                live_hashes.add((region, parameters.get('HashID')))
+                live_timestamps.add(
+                    (region, stack.stack_name.rsplit('-', 1)[1]))
+    for inventory in inventories:
+        region = inventory['region']
+        for stack in inventory['stacks']:
+            if stack.stack_status == 'DELETE_IN_PROGRESS':
+                continue
+            stack_type = get_stack_type(stack.stack_name)
+            timestamp = stack.stack_name.rsplit('-', 1)[1]
+            if stack_failed(stack):
+                orphans['stacks'].append((region, stack, stack_type))
+            elif stack_type not in SWEEP_SHARED_TYPES + ['MAIN'] and \
+                    (region, timestamp) not in live_timestamps and \
+                    past_sweep_grace(stack.creation_time, datetime.utcnow()):
+                orphans['stacks'].append((region, stack, stack_type))
+        for key_name in inventory['key_pairs']:
+            created = datetime.strptime(key_name.rsplit('-', 1)[1],
+                                        TIMESTAMP_FORMAT)
+            if (region, key_name) not in live_keys and \
+                    past_sweep_grace(created):
+                orphans['key_pairs'].append((region, key_name))
+        for app_name in inventory['applications']:
+            hash_id = app_name[len('%s-%s-' % (CODEDEPLOY_APP_NAME,
+                                               region)):]
+            if (region, hash_id) not in live_hashes:
+                orphans['applications'].append((region, app_name))
+    #  Only judge roles for regions whose stacks we could actually see
+    swept_regions = [inventory['region'] for inventory in inventories
+                     if not inventory['error'] and
+                     inventory['region'] in regions]
+    for role in roles:
+        if role['region'] in swept_regions and \
+                (role['region'], role['hash_id']) not in live_hashes and \
+                past_sweep_grace(role['created'], datetime.utcnow()):
+            orphans['roles'].append(role)
+    return orphans
+
+
+def sweep_stack(region, stack, stack_type):
+    if stack_type == 'S3':
+        outputs = {x.key: x.value for x in stack.outputs}
+        if DEMO_S3_BUCKET in outputs:
+            empty_related_buckets(s3_connect(region), outputs[DEMO_S3_BUCKET])
+    cfn_connect(region).delete_stack(stack.stack_name)
+
+
+def sweep_role(role_name):
+    iam_connection = iam_connect(DEFAULT_REGION)
+    response = iam_connection.list_role_policies(role_name)
+    result = response['list_role_policies_response']
+    for policy_name in result['list_role_policies_result']['policy_names']:
+        iam_connection.delete_role_policy(role_name, policy_name)
+    iam_connection.delete_role(role_name)
+
+
+def run_sweep_task(task):
+    label, func, func_args = task
+    try:
+        func(*func_args)
+    except BotoServerError as e:
+        return "FAILED %s: %s" % (label, e.error_message or e.reason)
+    return "Deleted %s." % label
+
+
+def sweep(args):
+    regions = args.sweep_regions or [
+        region.name for region in cfn_regions()
+        if not region.name.startswith(SWEEP_SKIP_REGION_PREFIXES)]
+    print "Inventorying %d region(s)..." % len(regions)
+    pool = ThreadPool(SWEEP_WORKERS)
+    roles_result = pool.apply_async(inventory_iam_roles)
+    inventories = pool.map(inventory_region, regions)
+    try:
+        roles = roles_result.get()
+    except BotoServerError as e:
+        print "Skipping IAM roles: %s" % (e.error_message or e.reason)
+        roles = list()
+    for inventory in inventories:
+        if inventory['error']:
+            print "Skipping %s: %s" % (inventory['region'],
+                                       inventory['error'])
+    orphans = find_orphans(inventories, roles, regions)
+    tasks = list()
+    for region, stack, stack_type in orphans['stacks']:
+        tasks.append(("%s stack %s (%s, %s)" % (stack_type, stack.stack_name,
+                                                 region, stack.stack_status),
+                      sweep_stack, (region, stack, stack_type)))
+    for region, app_name in orphans['applications']:
+        tasks.append(("CodeDeploy Application %s (%s)" % (app_name, region),
+                      lambda r, a: codedeploy_connect(r).delete_application(a),
+                      (region, app_name)))
+    for role in orphans['roles']:
+        tasks.append(("IAM Role %s" % role['name'], sweep_role,
+                      (role['name'],)))
+    for region, key_name in orphans['key_pairs']:
+        tasks.append(("EC2 Key Pair %s (%s)" % (key_name, region),
+                      lambda r, k: ec2_connect(r).delete_key_pair(k),
+                      (region, key_name)))
+    if not tasks:
+        print "No orphaned resources found."
+        pool.close()
+        return
+    if args.dry_run:
+        print "Dry run. The following orphaned resources would be deleted:"
+        for label, _, _ in tasks:
+            print label
+        pool.close()
+        return
+    print "Deleting %d orphaned resource(s)..." % len(tasks)
+    for result in pool.imap_unordered(run_sweep_task, tasks):
+        print result
+    pool.close()
+    pool.join()
+
+
+def history(args):
+    if not os.path.isfile(HISTORY_DB):
+        print "No build history found in %s." % HISTORY_DB
+        return
+    db = open_history()
+    builds = db.execute(
+        "SELECT id, started, stack_name, template_hash, status, duration "
+        "FROM builds WHERE region = ? ORDER BY id DESC LIMIT ?",
+        (args.region, HISTORY_WINDOW)).fetchall()
+    if not builds:
+        print "No builds recorded for %s." % args.region
+        db.close()
+        return
+    print "Recent builds in %s:" % args.region
+    for build_id, started, stack_name, template_hash, status, duration in \
+            builds:
+        print "%5d %s %-32s %-11s %8s  templates %s" % (
+            build_id, started, stack_name, status,
+            format_duration(duration) if duration else '-',
+            template_hash[:8])
+    latest_id = builds[0][0]
+    phases = db.execute("SELECT phase, duration, api_calls FROM phases "
+                        "WHERE build_id = ? ORDER BY rowid",
+                        (latest_id,)).fetchall()
+    print
+    print "Phases of build %d against the trailing median:" % latest_id
+    regressed = 0
+    for phase, duration, api_calls in phases:
+        typical = median(phase_durations(db, phase, args.region, latest_id))
+        flag = ""
+        if typical and duration > typical * HISTORY_REGRESSION_RATIO:
+            flag = "REGRESSED"
+            regressed += 1
+        print "%-40s %8s %8s %5d calls  %s" % (
+            phase, format_duration(duration),
+            format_duration(typical) if typical is not None else '-',
+            api_calls, flag)
+    if regressed:
+        print "%d phase(s) regressed more than %d%% over the median." % (
+            regressed, (HISTORY_REGRESSION_RATIO - 1) * 100)
+    db.close()
 
 
 def info(connections):
@@ -692,6 +1257,303 @@ def info(connections):
     pprint(stack.outputs, indent=2)
 
 
+def fetch_part(task):
+    region, bucket_name, key_name, etag, part_path, start, end = task
+    done = 0
+    if os.path.isfile(part_path):
+        done = os.path.getsize(part_path)
+    if start + done > end:
+        return 0, None
+    key = get_thread_bucket(region, bucket_name).new_key(key_name)
+    headers = {'Range': 'bytes=%d-%d' % (start + done, end),
+               'If-Match': etag}
+    try:
+        with open(part_path, 'ab') as part_file:
+            key.get_contents_to_file(part_file, headers=headers)
+    except S3ResponseError as e:
+        if e.status == 412:
+            #  Object changed since the partial download; start over next run
+            os.remove(part_path)
+        return 0, "FAILED %s: %s" % (key_name, e.reason)
+    except (socket.error, httplib.HTTPException) as e:
+        #  Dropped connections keep what arrived; the next run resumes it
+        return 0, "FAILED %s: %r" % (key_name, e)
+    return end - start - done + 1, None
+
+
+def read_fetch_etag(dest):
+    etag_path = '%s.etag' % dest
+    if not os.path.isfile(etag_path):
+        return None
+    with open(etag_path) as etag_file:
+        return etag_file.read()
+
+
+def discard_stale_fetch(dest, etag):
+    #  Parts and the finished file are only valid for the object version
+    #  they came from, which is recorded next to them in <dest>.etag
+    if read_fetch_etag(dest) == etag:
+        return
+    if os.path.isfile(dest):
+        os.remove(dest)
+    directory, name = os.path.split(dest)
+    for entry in os.listdir(directory):
+        suffix = entry[len(name):]
+        if entry.startswith(name) and re.match(r'\.part\d*$', suffix):
+            os.remove(os.path.join(directory, entry))
+    with open('%s.etag' % dest, 'w') as etag_file:
+        etag_file.write(etag)
+
+
+def plan_fetch(region, bucket_name, key, dest):
+    if key.size <= FETCH_PART_SIZE:
+        ranges = [('%s.part' % dest, 0, key.size - 1)]
+    else:
+        ranges = [('%s.part%d' % (dest, index), start,
+                   min(start + FETCH_PART_SIZE, key.size) - 1)
+                  for index, start in
+                  enumerate(range(0, key.size, FETCH_PART_SIZE))]
+    return [(region, bucket_name, key.name, key.etag, part_path, start, end)
+            for part_path, start, end in ranges]
+
+
+def assemble_fetch(dest, tasks):
+    part_paths = [task[4] for task in tasks]
+    for _, _, _, _, part_path, start, end in tasks:
+        if not os.path.isfile(part_path) or \
+                os.path.getsize(part_path) != end - start + 1:
+            return False
+    if len(part_paths) == 1:
+        os.rename(part_paths[0], dest)
+    else:
+        with open(dest, 'wb') as dest_file:
+            for path in part_paths:
+                with open(path, 'rb') as part_file:
+                    shutil.copyfileobj(part_file, dest_file)
+        for path in part_paths:
+            os.remove(path)
+    return True
+
+
+def fetch(connections, args):
+    bucket_name = args.bucket
+    if not bucket_name:
+        stack, _ = list_and_get_stacks(connections['cfn'],
+                                       stack_types=['S3'])[0]
+        outputs = {x.key: x.value for x in stack.outputs}
+        bucket_name = outputs[DEMO_S3_BUCKET]
+    dest_root = os.path.abspath(os.path.join(args.fetch_dir, bucket_name))
+    bucket = connections['s3'].get_bucket(bucket_name, validate=False)
+    print "Listing s3://%s/%s..." % (bucket_name, args.prefix)
+    objects = list()
+    for key in bucket.list(prefix=args.prefix):
+        if key.name.endswith('/'):
+            continue
+        modified = datetime.strptime(key.last_modified[:19],
+                                     '%Y-%m-%dT%H:%M:%S')
+        if args.since and modified < args.since:
+            continue
+        dest = os.path.abspath(os.path.join(dest_root, key.name))
+        if not dest.startswith(dest_root + os.sep):
+            print "Skipping %s, it would land outside %s." % (key.name,
+                                                             dest_root)
+            continue
+        if os.path.isfile(dest) and os.path.getsize(dest) == key.size and \
+                read_fetch_etag(dest) == key.etag:
+            continue
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        discard_stale_fetch(dest, key.etag)
+        objects.append((dest, plan_fetch(args.region, bucket_name, key,
+                                         dest)))
+    if not objects:
+        print "Nothing to fetch."
+        return
+    started = time.time()
+    tasks = [task for _, object_tasks in objects for task in object_tasks]
+    print "Fetching %d object(s) in %d part(s)..." % (len(objects),
+                                                     len(tasks))
+    pool = ThreadPool(FETCH_WORKERS)
+    fetched = 0
+    failures = list()
+    for size, failure in pool.imap_unordered(fetch_part, tasks):
+        fetched += size
+        if failure:
+            failures.append(failure)
+    pool.close()
+    pool.join()
+    completed = 0
+    for dest, object_tasks in objects:
+        #  Zero byte objects have no range to fetch
+        if object_tasks[0][6] < 0:
+            open(dest, 'wb').close()
+            completed += 1
+        elif assemble_fetch(dest, object_tasks):
+            completed += 1
+    for failure in failures:
+        print failure
+    print "Fetched %d of %d object(s), %.1f MB in %s, into %s." % (
+        completed, len(objects), fetched / 1048576.0,
+        format_duration(time.time() - started), dest_root)
+    if failures:
+        print "Run fetch again to resume the failed downloads."
+        sys.exit(1)
+
+
+def status(connections):
+    found = False
+    for stack in describe_all_stacks(connections['cfn']):
+        stack_type = get_stack_type(stack.stack_name)
+        if stack_type:
+            found = True
+            print "%-36s %-5s %s" % (stack.stack_name, stack_type,
+                                     stack.stack_status)
+    if not found:
+        print "No stacks found."
+
+
+def run_action(args):
+    connections = checkout_connections(args.region)
+    try:
+        if args.action == "info":
+            info(connections)
+        elif args.action == "status":
+            status(connections)
+        elif args.action == "build":
+            if not args.locations:
+                print "Please provide at least one IP Address."
+                sys.exit(1)
+            build(connections, args)
+        elif args.action == "destroy":
+            destroy(connections, args)
+        elif args.action == "fetch":
+            fetch(connections, args)
+    finally:
+        checkin_connections(args.region, connections)
+
+
+class RequestStream(object):
+    """Stands in for sys.stdin/sys.stdout, sending each daemon handler
+    thread to its own client socket and everything else to the console."""
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def bind(self, stream):
+        self.local.stream = stream
+
+    def unbind(self):
+        self.local.stream = None
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.local, 'stream', None) or self.default,
+                       name)
+
+
+class DaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+    """Runs one client request with stdin/stdout bound to the socket."""
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        args = argparse.Namespace(**request)
+        code = 0
+        sys.stdin.bind(self.rfile)
+        sys.stdout.bind(self.wfile)
+        try:
+            if args.action not in DAEMON_ACTIONS:
+                print "The daemon only handles %s." % ", ".join(DAEMON_ACTIONS)
+                code = 1
+            elif args.action in DAEMON_EXCLUSIVE_ACTIONS:
+                if not DAEMON_EXCLUSIVE_LOCK.acquire(False):
+                    print "Waiting for the running %s to finish..." % (
+                        " or ".join(DAEMON_EXCLUSIVE_ACTIONS))
+                    DAEMON_EXCLUSIVE_LOCK.acquire()
+                try:
+                    run_action(args)
+                finally:
+                    DAEMON_EXCLUSIVE_LOCK.release()
+            else:
+                run_action(args)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else int(bool(e.code))
+        except Exception:
+            traceback.print_exc(file=self.wfile)
+            code = 1
+        finally:
+            sys.stdin.unbind()
+            sys.stdout.unbind()
+        self.wfile.write("%s%d\n" % (DAEMON_EXIT_MARKER, code))
+
+
+def serve(args):
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = DaemonServer(args.socket, DaemonRequestHandler)
+    os.chmod(args.socket, 0600)
+    sys.stdin = RequestStream(sys.stdin)
+    sys.stdout = RequestStream(sys.stdout)
+    #  Warm the connections, stack inventory, templates and docker zip
+    connections = checkout_connections(args.region)
+    describe_all_stacks(connections['cfn'])
+    checkin_connections(args.region, connections)
+    for stack_data in STACK_DATA.values():
+        load_template(stack_data['template'])
+    prepare_docker_zip()
+    print "Serving %s on %s. Ctrl-C to stop." % (
+        ", ".join(DAEMON_ACTIONS), args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+def send_to_daemon(args):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(args.socket)
+    except socket.error:
+        print "No go.py daemon listening on %s. Run './go.py serve'." % (
+            args.socket)
+        sys.exit(1)
+    client.sendall(json.dumps(vars(args), default=str) + "\n")
+    watched = [client, sys.stdin]
+    pending = ''
+    while True:
+        readable, _, _ = select.select(watched, [], [])
+        if sys.stdin in readable:
+            line = sys.stdin.readline()
+            if line:
+                client.sendall(line)
+            else:
+                watched.remove(sys.stdin)
+        if client in readable:
+            data = client.recv(4096)
+            if not data:
+                print "Lost connection to the go.py daemon."
+                sys.exit(1)
+            pending += data
+            marker = pending.find(DAEMON_EXIT_MARKER[0])
+            if marker < 0:
+                sys.stdout.write(pending)
+                sys.stdout.flush()
+                pending = ''
+                continue
+            sys.stdout.write(pending[:marker])
+            sys.stdout.flush()
+            pending = pending[marker:]
+            if pending.endswith("\n"):
+                client.close()
+                sys.exit(int(pending[len(DAEMON_EXIT_MARKER):]))
+
+
 def main():
     if sys.version_info[:3] > (2, 7, 8):
         print "There is currently an SSL issue with Python 2.7.9 and newer."
@@ -723,32 +1585,56 @@ def main():
                         help="Always build all components. (VPC, RDS, etc.)")
     parser.add_argument('--warm', action='store_true',
                         help="Only build VPC, SG, and RDS")
+    parser.add_argument('--sweep-regions', nargs='*', action="store",
+                        dest="sweep_regions", help="""If sweeping, limit
+                        the sweep to these regions. (Default: all)""")
+    parser.add_argument('--dry-run', action='store_true', dest="dry_run",
+                        help="If sweeping, only list orphaned resources")
+    parser.add_argument('--bucket', action="store", dest="bucket",
+                        help="""If fetching, the bucket to download from.
+                        (Default: pick a demo S3 stack)""")
+    parser.add_argument('--prefix', action="store", dest="prefix", default='',
+                        help="If fetching, only download keys with prefix")
+    parser.add_argument('--since', action="store", dest="since",
+                        type=timestamp_type, help="""If fetching, only
+                        download objects modified since this UTC time.
+                        (YYYYMMDDHHMMSS or YYYY-MM-DD)""")
+    parser.add_argument('--dest', action="store", dest="fetch_dir",
+                        default=FETCH_DIR,
+                        help="If fetching, directory to download into")
+    parser.add_argument('--daemon', action='store_true', dest="use_daemon",
+                        help="""Send %s to a running './go.py serve'
+                        instead of running it here.""" %
+                        ", ".join(DAEMON_ACTIONS))
+    parser.add_argument('--socket', action="store", dest="socket",
+                        default=DAEMON_SOCKET,
+                        help="Unix socket for serve and --daemon")
     args = parser.parse_args()
     if args.password_prompt:
         print "WARNING: Password will be passed to CFN in plain text."
         args.jenkins_password = getpass.getpass()
     else:
         args.jenkins_password = JENKINS_PASSWORD
-    connections = dict()
-    connections['cfn'] = cfn_connect(args.region)
-    if args.action == "info":
-        info(connections)
+    if args.action == "sweep":
+        sweep(args)
         sys.exit(0)
-    connections['codedeploy'] = codedeploy_connect(args.region)
-    connections['ec2'] = ec2_connect(args.region)
-    connections['iam'] = iam_connect(args.region)
-    connections['s3'] = s3_connect(args.region)
+    if args.action == "history":
+        history(args)
+        sys.exit(0)
+    if args.action == "serve":
+        serve(args)
+        sys.exit(0)
+    if args.use_daemon and args.action in DAEMON_ACTIONS:
+        send_to_daemon(args)
     if args.action == "test":
+        checkout_connections(args.region)
         #  Test pieces here
         sys.exit(0)
-    if args.action == "build":
-        if not args.locations:
-            print "Please provide at least one IP Address."
-            parser.print_help()
-            sys.exit(1)
-        build(connections, args)
-    elif args.action == "destroy":
-        destroy(connections, args)
+    if args.action == "build" and not args.locations:
+        print "Please provide at least one IP Address."
+        parser.print_help()
+        sys.exit(1)
+    run_action(args)
 
 
 if __name__ == '__main__':